@@ -19,19 +19,23 @@ import os
 import re
 import shutil
 import warnings
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
 from pathlib import Path
 
 import apsw
 import boto3
 import geopandas as gpd
 import pandas as pd
+from boto3.s3.transfer import TransferConfig
 from rsxml import Logger, ProgressBar, dotenv
 from rsxml.util import safe_makedirs
 from semver import Version
-from shapely import wkb
 
 from pydex import RiverscapesAPI, RiverscapesProject
 from pydex.lib.athena import query_to_dataframe
+from pydex.lib.files import scan_files
+from pydex.lib.sqlite import tune_for_reading
 
 # Environment-configurable data bucket for scraped parquet uploads.
 DATA_BUCKET_ENV_VAR = "RME_DATA_BUCKET"
@@ -40,6 +44,27 @@ BASE_S3_KEY = "data_exchange/rs_metric_engine2"
 
 DATA_BUCKET = os.getenv(DATA_BUCKET_ENV_VAR, DEFAULT_DATA_BUCKET)
 
+# RegEx string for finding RME output GeoPackages on the Data Exchange, and the
+# equivalent literal file name ending for finding them among the local downloads
+RME_SCRAPE_GPKG_REGEX = r'.*riverscapes_metrics.gpkg'
+RME_SCRAPE_GPKG_SUFFIX = 'riverscapes_metrics.gpkg'
+
+# Projects downloaded at once, and projects extracted and uploaded at once
+DOWNLOAD_WORKERS = 4
+PROCESS_WORKERS = 2
+# Cap on projects downloading, downloaded or being processed. With --delete this is also
+# the most project folders that are on disk at once.
+MAX_PROJECTS_IN_FLIGHT = DOWNLOAD_WORKERS + PROCESS_WORKERS
+
+# RME tables joined on dgoid whose columns all go into the output
+METRIC_TABLES = ['dgo_desc', 'dgo_geomorph', 'dgo_veg', 'dgo_hydro', 'dgo_impacts', 'dgo_beaver']
+
+# Rows per parquet row group in the uploaded files
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+
+# Upload the larger parquet files in 16MB parts, 8 at a time
+S3_TRANSFER_CONFIG = TransferConfig(multipart_chunksize=16 * 1024 * 1024, max_concurrency=8, use_threads=True)
+
 # Query to identify projects to add/replace. No semicolon allowed.
 missing_projects_query = """
 with huc_projects_dex as
@@ -78,25 +103,29 @@ def semver_to_int(version: Version) -> int:
     return version.major * MAJOR + version.minor * MINOR + version.patch
 
 
-def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, regex: str) -> str:
+def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, regex: str, suffix: str | None = None) -> str:
     """
     Download files from a project on Data Exchange that match the regex string
     Return the path to the downloaded file
+
+    If the regex is really just a literal file name ending, pass that as suffix so the
+    local check can use a plain endswith instead of the regex. The regex is still used
+    to filter the Data Exchange download.
     """
     # check if it has previously been downloaded
     log = Logger('download RS DEX file')
-    gpkg_path = get_matching_file(download_dir, regex)
-    if gpkg_path is not None and os.path.isfile(gpkg_path):
+    gpkg_path = get_matching_file_suffix(download_dir, suffix) if suffix else get_matching_file(download_dir, regex)
+    if gpkg_path is not None:
         log.debug(f'file for matching {regex} previously downloaded')
         return gpkg_path
 
     rs_api.download_files(project_id, download_dir, [regex])
 
-    gpkg_path = get_matching_file(download_dir, regex)
+    gpkg_path = get_matching_file_suffix(download_dir, suffix) if suffix else get_matching_file(download_dir, regex)
     log.debug(f'file for {project_id} downloaded to {gpkg_path}')
 
     # Cannot proceed with this HUC if the output GeoPackage is missing
-    if gpkg_path is None or not os.path.isfile(gpkg_path):
+    if gpkg_path is None:
         raise FileNotFoundError(f'Could not find output GeoPackage in {download_dir}')
 
     return gpkg_path
@@ -111,11 +140,22 @@ def get_matching_file(parent_dir: str, regex_str: str) -> str | None:
     """
 
     regex = re.compile(regex_str)
-    for root, __dirs, files in os.walk(parent_dir):
-        for file_name in files:
-            # Check if the file name matches the regex
-            if regex.match(file_name):
-                return os.path.join(root, file_name)
+    for entry in scan_files(parent_dir):
+        # Check if the file name matches the regex. The DirEntry already knows it is a file.
+        if regex.match(entry.name):
+            return entry.path
+
+    return None
+
+
+def get_matching_file_suffix(parent_dir: str, suffix: str) -> str | None:
+    """
+    Same as get_matching_file, but for a literal file name ending rather than a regex.
+    """
+
+    for entry in scan_files(parent_dir):
+        if entry.name.endswith(suffix):
+            return entry.path
 
     return None
 
@@ -124,10 +164,8 @@ def download_rme_geopackage(rs_api: RiverscapesAPI, project: RiverscapesProject,
     """
     Download the RME GeoPackage for a project and return its file path.
     """
-    # RegEx string for finding RME output GeoPackages
-    RME_SCRAPE_GPKG_REGEX = r'.*riverscapes_metrics.gpkg'
     # NOTE: will not overwrite existing files - which can be a problem.
-    rme_gpkg = download_file(rs_api, project.id, huc_dir, RME_SCRAPE_GPKG_REGEX)  # pyright: ignore[reportArgumentType]
+    rme_gpkg = download_file(rs_api, project.id, huc_dir, RME_SCRAPE_GPKG_REGEX, RME_SCRAPE_GPKG_SUFFIX)  # pyright: ignore[reportArgumentType]
     return rme_gpkg
 
 
@@ -155,8 +193,18 @@ def extract_metrics_to_geodataframe(gpkg_path: str, spatialite_path: str) -> gpd
     conn = apsw.Connection(gpkg_path)
     conn.enable_load_extension(True)
     conn.load_extension(spatialite_path)
-
-    sql = '''
+    # The metrics join reads every row of seven tables, so let SQLite memory-map the file
+    tune_for_reading(conn)
+
+    # Name every metric column explicitly, leaving out each table's dgoid join key,
+    # so the duplicate dgoid columns never reach pandas
+    metric_columns = []
+    for table in METRIC_TABLES:
+        for _cid, name, *_rest in conn.execute(f'PRAGMA table_info({table})'):
+            if name.lower() != 'dgoid':
+                metric_columns.append(f'{table}."{name}"')
+
+    sql = f'''
         SELECT
             dgos.level_path,
             dgos.seg_distance,
@@ -165,12 +213,7 @@ def extract_metrics_to_geodataframe(gpkg_path: str, spatialite_path: str) -> gpd
             dgos.FCode as fcode,
             ST_X(ST_CENTROID(castautomagic(dgos.geom))) longitude,
             ST_Y(ST_CENTROID(castautomagic(dgos.geom))) latitude,
-            dgo_desc.*,
-            dgo_geomorph.*,
-            dgo_veg.*,
-            dgo_hydro.*,
-            dgo_impacts.*,
-            dgo_beaver.*,
+            {', '.join(metric_columns)},
             ST_AsBinary(CastAutomagic(dgos.geom)) dgo_geom
         FROM dgo_desc
             INNER JOIN dgo_geomorph ON dgo_desc.dgoid = dgo_geomorph.dgoid
@@ -199,10 +242,8 @@ def extract_metrics_to_geodataframe(gpkg_path: str, spatialite_path: str) -> gpd
     except Exception as e:
         raise Exception(f"Could not apply data dictionary types: {e}") from e
 
-    # Remove all columns named 'dgoid' (case-insensitive, even if duplicated)
-    df = df.loc[:, [col for col in df.columns if col.lower() != 'dgoid']]
-    # convert wkb geometry to shapely objects
-    df['dgo_geom'] = df['dgo_geom'].apply(wkb.loads)  # pyright: ignore[reportCallIssue, reportArgumentType]
+    # convert wkb geometry to shapely objects in one vectorized call rather than one wkb.loads per row
+    df['dgo_geom'] = gpd.GeoSeries.from_wkb(df['dgo_geom'].to_numpy(), index=df.index, crs='EPSG:4326')
     gdf = gpd.GeoDataFrame(df, geometry='dgo_geom', crs='EPSG:4326')
 
     # Reproject to EPSG:5070 for simplification
@@ -234,6 +275,12 @@ def delete_folder(dirpath: Path) -> None:
             log.error(f'Error deleting download directory {dirpath}: {e}')
 
 
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """Shared S3 client. boto3 clients are thread-safe, so every worker can use this one."""
+    return boto3.client('s3')
+
+
 def upload_to_s3(file_path: str | Path, s3_bucket: str, s3_key: str) -> None:
     """upload a file to s3
 
@@ -243,8 +290,7 @@ def upload_to_s3(file_path: str | Path, s3_bucket: str, s3_key: str) -> None:
         s3_key (str): s3_key (including 'folders'?)
     """
     log = Logger('upload to s3')
-    s3 = boto3.client('s3')
-    s3.upload_file(file_path, s3_bucket, s3_key)
+    get_s3_client().upload_file(str(file_path), s3_bucket, s3_key, Config=S3_TRANSFER_CONFIG)
     log.debug(f'file uploaded to s3 {s3_bucket} {s3_key}')
 
 
@@ -276,58 +322,107 @@ def scrape_rme(
         log.info("Query to identify projects to scrape returned no results.")
         return
     log.info(f"Query to identify projects to scrape returned {len(projects_to_add_df)} projects.")
+    # Every project for a HUC uploads to the same rme_<huc>.parquet key, and projects run concurrently,
+    # so only scrape the newest project for each HUC. That is the one whose file should end up in S3.
+    projects_to_add_df = projects_to_add_df.sort_values('created_on').drop_duplicates('huc', keep='last')
+    log.info(f"{len(projects_to_add_df)} projects remain after keeping only the newest project for each HUC.")
     # test a single project
     # projects_to_add_df = pd.DataFrame({'project_id': ['5aeff0f8-5a8e-4db8-8e6c-9e507b20eca0']})
     count = 0
     errors = 0
     prg = ProgressBar(projects_to_add_df.shape[0], text="Scrape Progress")
-    for project_id in projects_to_add_df['project_id']:
-        project = rs_api.get_project_full(project_id)
-        if project.huc is None or project.huc == '':
-            log.warning(f'Project {project.id} does not have a HUC. Skipping.')
-            continue
 
-        # this truncates to nearest second, for whatever reason
-        project_created_date_ts = int(project.created_date.timestamp()) * 1000  # pyright: ignore[reportOptionalMemberAccess] Projects always have a created_date
+    # Downloads run on their own pool so the next projects are fetched while earlier ones
+    # are being extracted and uploaded on the processing pool. New downloads are only started
+    # while fewer than MAX_PROJECTS_IN_FLIGHT projects are in either pool, so the downloads
+    # can't run ahead of the processing and fill the disk.
+    project_ids = iter(projects_to_add_df['project_id'])
+    # future -> (True for a download, False for processing, project id)
+    in_flight: dict[Future, tuple[bool, str]] = {}
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_pool, ThreadPoolExecutor(max_workers=PROCESS_WORKERS) as process_pool:
+        while True:
+            while len(in_flight) < MAX_PROJECTS_IN_FLIGHT:
+                project_id = next(project_ids, None)
+                if project_id is None:
+                    break
+                in_flight[download_pool.submit(download_project, rs_api, project_id, download_dir)] = (True, project_id)
+            if not in_flight:
+                break
+
+            done, _pending = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                is_download, project_id = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors += 1
+                    log.error(f'Error {"downloading" if is_download else "scraping"} project {project_id}: {e}')
+                    prg.update(count + errors)
+                    continue
+                if not is_download:
+                    count += 1
+                    prg.update(count + errors)
+                elif result is not None:
+                    project, project_dir, gpkg_path = result
+                    in_flight[process_pool.submit(process_project, project, project_dir, gpkg_path, spatialite_path, data_bucket, delete_downloads_when_done)] = (False, project_id)
+    prg.finish()
+    log.info(f"Scraped {count} projects successfully and {errors} failed.")
 
-        if project.model_version is None:
-            log.warning(f'Project {project.id} does not have a model version. Skipping.')
-            continue
 
-        model_version_int = semver_to_int(project.model_version)
+def download_project(rs_api: RiverscapesAPI, project_id: str, download_dir: Path) -> tuple[RiverscapesProject, Path, str] | None:
+    """
+    Fetch a project and download its RME GeoPackage into its own folder under the HUC folder.
+    Returns the project, its folder and the GeoPackage path, or None for projects that can't be scraped.
+    """
+    log = Logger('Scrape RME')
+    project = rs_api.get_project_full(project_id)
+    if project.huc is None or project.huc == '':
+        log.warning(f'Project {project.id} does not have a HUC. Skipping.')
+        return None
 
-        try:
-            huc_dir = download_dir / project.huc
-            safe_makedirs(str(huc_dir))
-            gpkg_path = download_rme_geopackage(rs_api, project, huc_dir)
-            data_gdf = extract_metrics_to_geodataframe(gpkg_path, spatialite_path)
-            # add common project-level columns
-            data_gdf['rme_project_id'] = project.id
-            data_gdf['rme_date_created_ts'] = project_created_date_ts
-            data_gdf['rme_version'] = str(project.model_version)
-            data_gdf['rme_version_int'] = model_version_int
-
-            log.debug(f"Dataframe prepared with shape {data_gdf.shape}")
-            # until we have a more robust schema check this is something
-            if len(data_gdf.columns) != 135:
-                log.warning(f"Expected 135 columns, got {len(data_gdf.columns)}")
-            rme_pq_filepath = huc_dir / f'rme_{project.huc}.parquet'
-            data_gdf.to_parquet(rme_pq_filepath)
-            # do not use os.path.join because this is aws os, not system os
-            s3_key = f'{BASE_S3_KEY}/{rme_pq_filepath.name}'
-            upload_to_s3(rme_pq_filepath, data_bucket, s3_key)
-
-            if delete_downloads_when_done:
-                delete_folder(download_dir)
-            count += 1
-            prg.update(count + errors)
-        except Exception as e:
-            errors += 1
-            log.error(f'Error scraping HUC {project.huc}: {e}')
-            prg.update(count + errors)
-            # raise
-    prg.finish()
-    log.info(f"Scraped {count} projects successfully and {errors} failed.")
+    if project.model_version is None:
+        log.warning(f'Project {project.id} does not have a model version. Skipping.')
+        return None
+
+    # Several projects can share a HUC, so each gets its own folder that no other worker touches
+    project_dir = download_dir / project.huc / project.id
+    safe_makedirs(str(project_dir))
+    return project, project_dir, download_rme_geopackage(rs_api, project, project_dir)
+
+
+def process_project(project: RiverscapesProject, project_dir: Path, gpkg_path: str, spatialite_path: str, data_bucket: str, delete_downloads_when_done: bool) -> None:
+    """
+    Extract the metrics from a downloaded RME GeoPackage, write them to GeoParquet and upload to S3.
+    Each call opens its own SpatiaLite connection, so this is safe to run on several threads.
+    """
+    log = Logger('Scrape RME')
+
+    # this truncates to nearest second, for whatever reason
+    project_created_date_ts = int(project.created_date.timestamp()) * 1000  # pyright: ignore[reportOptionalMemberAccess] Projects always have a created_date
+    model_version_int = semver_to_int(project.model_version)  # pyright: ignore[reportArgumentType] checked in download_project
+
+    data_gdf = extract_metrics_to_geodataframe(gpkg_path, spatialite_path)
+    # add common project-level columns
+    data_gdf['rme_project_id'] = project.id
+    data_gdf['rme_date_created_ts'] = project_created_date_ts
+    data_gdf['rme_version'] = str(project.model_version)
+    data_gdf['rme_version_int'] = model_version_int
+
+    log.debug(f"Dataframe prepared with shape {data_gdf.shape}")
+    # until we have a more robust schema check this is something
+    if len(data_gdf.columns) != 135:
+        log.warning(f"Expected 135 columns, got {len(data_gdf.columns)}")
+    rme_pq_filepath = project_dir / f'rme_{project.huc}.parquet'
+    # zstd gives noticeably smaller files than the default snappy, which cuts both the upload and Athena's scan cost.
+    # pyarrow already dictionary-encodes the repetitive columns (level_path, fcode, rme_version) by default.
+    data_gdf.to_parquet(rme_pq_filepath, engine='pyarrow', compression='zstd', compression_level=3, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    # do not use os.path.join because this is aws os, not system os
+    s3_key = f'{BASE_S3_KEY}/{rme_pq_filepath.name}'
+    upload_to_s3(rme_pq_filepath, data_bucket, s3_key)
+
+    if delete_downloads_when_done:
+        # Only this project's folder; the other workers are still using theirs
+        delete_folder(project_dir)
 
 
 def main():
@@ -1,9 +1,12 @@
 # File for handling conditional imports
+from functools import lru_cache
+
 from termcolor import colored
 
 # First a function to import sqlite3
 
 
+@lru_cache(maxsize=1)
 def import_sqlite3():
     """Import sqlite3 module
 
@@ -19,9 +22,12 @@ def import_sqlite3():
         exit(1)
 
 
+@lru_cache(maxsize=1)
 def import_geo():
     """Import gdal module
 
+    The result is cached so every pydex module that calls this shares one lookup.
+
     Returns:
         gdal: The gdal module if successfully imported
     """
@@ -18,6 +18,11 @@ import pandas as pd
 from rsxml import Logger
 S3_ATHENA_BUCKET = "riverscapes-athena-output"
 
+# Polling starts fast so short queries return promptly, then backs off for long-running ones
+POLL_INITIAL_DELAY = 0.1
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF = 1.5
+
 
 def query_to_dataframe(query: str, querylabel: str = "") -> pd.DataFrame:
     """uses awswrangler to return a DataFrame for a given query
@@ -256,6 +261,7 @@ def _run_athena_query(
     log.debug(f"Query started at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time))}")
 
     # Poll for completion
+    delay = POLL_INITIAL_DELAY
     while True:
         status = athena.get_query_execution(QueryExecutionId=query_execution_id)
         state = status['QueryExecution']['Status']['State']
@@ -268,7 +274,8 @@ def _run_athena_query(
             output_path = status['QueryExecution']['ResultConfiguration'].get('OutputLocation', '')
             log.error(f"S3 OutputLocation (may be empty): {output_path}")
             return None
-        time.sleep(2)
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
 
     if state != 'SUCCEEDED':
         reason = status['QueryExecution']['Status'].get('StateChangeReason', '')
@@ -311,12 +318,14 @@ def athena_query(s3_bucket: str, query: str):
     query_execution_id = response['QueryExecutionId']
 
     # Poll for completion
+    delay = POLL_INITIAL_DELAY
     while True:
         status = athena.get_query_execution(QueryExecutionId=query_execution_id)
         state = status['QueryExecution']['Status']['State']
         if state in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
             break
-        time.sleep(2)  # Wait before polling again
+        time.sleep(delay)  # Wait before polling again
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
 
     if state != 'SUCCEEDED':
         print(f"Athena query failed or was cancelled: {state}")
@@ -0,0 +1,18 @@
+"""Helpers for finding files on the local file system"""
+
+import os
+from collections.abc import Iterator
+
+
+def scan_files(root_dir: str) -> Iterator[os.DirEntry]:
+    """Yield a DirEntry for every file under root_dir. Like os.walk, unreadable folders are skipped."""
+    try:
+        entries = os.scandir(root_dir)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_files(entry.path)
+            elif entry.is_file():
+                yield entry
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import math
+from collections import Counter
 from os import path
 from time import time
 
@@ -41,6 +42,8 @@ class Raster:
             self.nodata = srcband.GetNoDataValue()
             """ Turn a Raster with a single band into a 2D [x,y] = v array """
             self.array = srcband.ReadAsArray()
+            # Byte/UInt16 rasters can be counted with np.bincount instead of a full sort
+            self._is_small_int = np.issubdtype(self.array.dtype, np.unsignedinteger) and self.array.dtype.itemsize <= 2
 
             # Now mask out any NAN or nodata values (we do both for consistency)
             if self.nodata is not None:
@@ -68,6 +71,9 @@ class Raster:
             self.cellWidth = self.gt[1]
             self.top = self.gt[3]
             self.cellHeight = self.gt[5]
+            # Precompute the inverse cell sizes so pixel lookups multiply instead of divide
+            self._inv_cw = 1.0 / self.cellWidth
+            self._inv_ch = 1.0 / self.cellHeight
             self.cols = src_ds.RasterXSize
             self.rows = src_ds.RasterYSize
             # Important to throw away the srcband
@@ -186,8 +192,8 @@ class Raster:
         """
         # Convert from map to pixel coordinates.
         # Only works for geotransforms with no rotation.
-        px = int((pt[0] - self.left) / self.cellWidth)  # x pixel
-        py = int((pt[1] - self.top) / self.cellHeight)  # y pixel
+        px = int((pt[0] - self.left) * self._inv_cw)  # x pixel
+        py = int((pt[1] - self.top) * self._inv_ch)  # y pixel
         val = self.array[py, px]
         if isclose(val, self.nodata, rel_tol=1e-07) or val is np.ma.masked:
             return np.nan
@@ -262,22 +268,21 @@ class Raster:
         :param incomingArray:
         :return:
         """
-        masked = isinstance(self.array, np.ma.MaskedArray)
-        if copy:
-            if masked:
-                self.array = np.ma.copy(incomingArray)
-            else:
-                self.array = np.ma.masked_invalid(incomingArray, copy=True)
+        # A MaskedArray keeps the caller's mask. masked_invalid adds any NaN/Inf cells left unmasked to it.
+        incoming = incomingArray if isinstance(incomingArray, np.ma.MaskedArray) else np.asarray(incomingArray)
+        if np.issubdtype(incoming.dtype, np.floating):
+            self.array = np.ma.masked_invalid(incoming, copy=copy)
+        elif isinstance(incoming, np.ma.MaskedArray):
+            self.array = np.ma.copy(incoming) if copy else incoming
         else:
-            if masked:
-                self.array = incomingArray
-            else:
-                self.array = np.ma.masked_invalid(incomingArray)
+            # Integer arrays can't hold NaN/Inf so there is nothing to scan for
+            self.array = np.ma.array(incoming, mask=np.ma.nomask, copy=copy)
 
         self.rows = self.array.shape[0]
         self.cols = self.array.shape[1]
-        self.min = np.nanmin(self.array)
-        self.max = np.nanmax(self.array)
+        # The mask already excludes invalid cells so a plain min/max is enough
+        self.min = self.array.min()
+        self.max = self.array.max()
 
     def bin_raster_categorical(self, window_size: int = 256) -> dict[str, int]:
         """Bin raster values into categories based on unique values in the raster.
@@ -294,7 +299,8 @@ class Raster:
         band = ds.GetRasterBand(1)
         cols, rows = ds.RasterXSize, ds.RasterYSize
 
-        category_counts: dict[str, int] = {}
+        # Keyed by integer category until the very end so each tile only merges ints
+        category_counts: Counter[int] = Counter()
         retval = {
             'min': float(self.min),
             'max': float(self.max),
@@ -314,28 +320,41 @@ class Raster:
             for xoff in range(0, cols, window_size):
                 xsize = min(window_size, cols - xoff)
                 ysize = min(window_size, rows - yoff)
-                arr = band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float32)
-                if nodata is not None:
-                    arr = arr[arr != nodata]
-                if arr.size == 0:
+                arr = band.ReadAsArray(xoff, yoff, xsize, ysize)
+                if self._is_small_int:
+                    # O(n) histogram over the raw integers, then drop the nodata bucket.
+                    # A NaN or infinite nodata can't occur in an integer band and int() would raise on it.
+                    all_counts = np.bincount(arr.ravel())
+                    if nodata is not None and math.isfinite(nodata) and nodata == int(nodata) and 0 <= nodata < all_counts.size:
+                        all_counts[int(nodata)] = 0
+                    unique = np.nonzero(all_counts)[0]
+                    counts = all_counts[unique]
+                    value_count = int(counts.sum())
+                else:
+                    arr = arr.astype(np.float32)
+                    if nodata is not None:
+                        arr = arr[arr != nodata]
+                    unique, counts = np.unique(arr, return_counts=True)
+                    value_count = arr.size
+                if value_count == 0:
                     continue
-                unique, counts = np.unique(arr, return_counts=True)
                 gt = ds.GetGeoTransform()
                 x0 = gt[0] + xoff * gt[1]
                 y0 = gt[3] + yoff * gt[5]
-                window_counts = dict(zip((str(int(u)) for u in unique), map(int, counts)))
-                print(f"Window ({xoff},{yoff}) @ ({x0:.1f},{y0:.1f}): counts={window_counts}")
-                retval['value_count'] += arr.size
-                for category, count in window_counts.items():
-                    # Category should be the string representation of an integer
-                    category_counts[category] = category_counts.get(category, 0) + count
+                print(f"Window ({xoff},{yoff}) @ ({x0:.1f},{y0:.1f}): categories={len(unique)} cells={value_count}")
+                retval['value_count'] += value_count
+                for category, count in zip(unique.tolist(), counts.tolist()):
+                    category_counts[int(category)] += count
         end_time = time()
 
+        # Category should be the string representation of an integer
+        str_counts = {str(k): v for k, v in category_counts.items()}
+
         self.log.info(f"Completed binning in {end_time - start_time:.2f} seconds")
-        self.log.debug(f"Category Counts: \n\n{json.dumps(category_counts, indent=2)}\n")
+        self.log.debug(f"Category Counts: \n\n{json.dumps(str_counts, indent=2)}\n")
 
         # Final shape needs to be : [{category: '1', count: 100}, ...]
-        retval['bins'] = [{'category': k, 'cell_count': v} for k, v in category_counts.items()]
+        retval['bins'] = [{'category': k, 'cell_count': v} for k, v in str_counts.items()]
 
         return retval
 
@@ -0,0 +1,17 @@
+"""Helpers for SQLite and GeoPackage connections. They work with both sqlite3 and apsw connections."""
+
+# Settings for a connection that only ever reads from the database: writes are refused,
+# temporary sort and GROUP BY b-trees stay in memory, the page cache is 256MB and the
+# file is memory-mapped so pages are read without a read() call each.
+READ_PRAGMAS = [
+    'PRAGMA query_only = 1',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',
+    'PRAGMA mmap_size = 30000000000',
+]
+
+
+def tune_for_reading(conn) -> None:
+    """Apply READ_PRAGMAS to a connection that is only used to read a GeoPackage"""
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
@@ -29,6 +29,9 @@ SUM_AREA_ZERO_COUNT = 'sum_area_zero_count'
 RME_OUTPUT_GPKG_REGEX = r'.*riverscapes_metrics\.gpkg'
 RCAT_OUTPUT_GPKG_REGEX = r'.*rcat\.gpkg'
 
+# Rows copied per executemany call when copying a table between databases
+COPY_BATCH_SIZE = 10_000
+
 
 # These are RME metrics than can be scraped. The items in each Tuple are:
 # 1. The name of the metric in the RME database (not used by this code)
@@ -172,24 +175,22 @@ def copy_table_between_cursors(src_cursor, dest_cursor, table_name):
     """
 
     # Get table schema from the source database
-    src_cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}'")
+    src_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", [table_name])
     create_table_sql = src_cursor.fetchone()['sql']
     dest_cursor.execute(create_table_sql)
 
-    # Get all data from the source table
-    src_cursor.execute(f"SELECT * FROM {table_name}")
-    rows = src_cursor.fetchall()
-
     # Get the column names from the source table
-    src_cursor.execute(f"PRAGMA table_info({table_name})")
+    src_cursor.execute(f'PRAGMA table_info("{table_name}")')
     columns = [info['name'] for info in src_cursor.fetchall()]  # info[1] gives the column names
-    columns_str = ', '.join(columns)
+    columns_str = ', '.join(f'"{col}"' for col in columns)
 
-    # Insert data into the destination table
+    # Insert data into the destination table in batches straight from the source cursor,
+    # so the whole table is never held in memory
     placeholders = ', '.join(['?' for _ in columns])  # Create placeholders for SQL insert
-    insert_sql = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders})"
-    row_tuples = [[row[col] for col in columns] for row in rows]
-    dest_cursor.executemany(insert_sql, row_tuples)
+    insert_sql = f'INSERT INTO "{table_name}" ({columns_str}) VALUES ({placeholders})'
+    src_cursor.execute(f'SELECT {columns_str} FROM "{table_name}"')
+    while batch := src_cursor.fetchmany(COPY_BATCH_SIZE):
+        dest_cursor.executemany(insert_sql, [[row[col] for col in columns] for row in batch])
 
 
 def scrape_rme_statistics(curs: sqlite3.Cursor, state: dict[str, str], flow: dict[str, str], owner: dict[str, str], output: dict[str, float]) -> None:
@@ -7,18 +7,19 @@ and then searching for all projects since midnight UTC of that date.
 Philip Bailey
 27 June 2025
 
-The script creates an SQLite in-memory database to store the project data, which is then written to temporary CSV files
-and uploaded to an S3 bucket. The Athena table is expected to be created beforehand with the following DDL:
+The script buckets the project data in memory by project type, model version and creation day. Each bucket is then
+written to an in-memory Parquet buffer and uploaded to an S3 bucket. The Athena table is expected to be created beforehand with the following DDL:
 
 ```sql
 -- Athena table creation DDL
 -- This table is used to store project data scraped from the Data Exchange API.
 -- The table is expected to be created in the 'default' database in Athena.
--- The S3 location is where the CSV files will be uploaded.
--- The table properties are set to skip the header line in the CSV files.
+-- The S3 location is where the Parquet files will be uploaded.
 -- Make sure to adjust the S3 location to your specific bucket and path.
 -- Example S3 location: s3://your-bucket-name/data_exchange_projects
--- The table is stored as TEXTFILE with tab-separated values.
+-- The table is stored as snappy-compressed PARQUET. Column names must match PARQUET_SCHEMA in this script.
+-- The Parquet files live under their own prefix (S3_PREFIX) because the old data_exchange/projects prefix
+-- still holds the TSV files written by earlier versions of this script, which a PARQUET table can't read.
 -- Make sure to run this DDL before running the script.
 
 CREATE
@@ -26,8 +27,9 @@ EXTERNAL TABLE rs_projects (
     project_id      STRING,
     name            STRING,
     tags            ARRAY<STRING>,
-    huc10           CHAR(10),
+    huc10           STRING,
     model_version_int INT,
+    archived        INT,
     created_on      BIGINT,
     created_on_date STRING,
     owned_by_id     STRING,
@@ -35,43 +37,102 @@ EXTERNAL TABLE rs_projects (
     owned_by_type   STRING
 )
 PARTITIONED BY (project_type_id STRING, model_version STRING)
-ROW FORMAT DELIMITED FIELDS TERMINATED BY '\t'
-STORED AS TEXTFILE LOCATION 's3://riverscapes-athena/data_exchange/projects'
-TBLPROPERTIES ('skip.header.line.count'='1',
-'collection.delim' = '|'
-);
+STORED AS PARQUET LOCATION 's3://riverscapes-athena/data_exchange/projects_parquet'
+TBLPROPERTIES ('parquet.compression'='SNAPPY');
 
 MSCK REPAIR TABLE rs_projects;
 ```
 """
 
 import argparse
-import csv
-import os
-import sqlite3
-import tempfile
+import io
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import UTC, datetime
 
 import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
 from rsxml import dotenv
 
 from pydex import RiverscapesAPI, RiverscapesSearchParams
 from pydex.lib.athena import athena_execute, athena_query_get_parsed
 
+# Columns written to each Parquet file. The partition keys (project_type_id and model_version) are
+# not included because Athena derives them from the S3 key. The types are fixed up front so Arrow
+# doesn't have to infer them and every partition file has an identical schema.
+PARQUET_SCHEMA = pa.schema(
+    [
+        ('project_id', pa.string()),
+        ('name', pa.string()),
+        ('tags', pa.list_(pa.string())),
+        ('huc10', pa.string()),
+        ('model_version_int', pa.int32()),
+        ('archived', pa.int32()),
+        ('created_on', pa.int64()),
+        ('created_on_date', pa.string()),
+        ('owned_by_id', pa.string()),
+        ('owned_by_name', pa.string()),
+        ('owned_by_type', pa.string()),
+    ]
+)
+PARQUET_ROW_GROUP_SIZE = 1_000_000
+
+# Key prefix for the partition files. Must match the LOCATION in the DDL above.
+S3_PREFIX = 'data_exchange/projects_parquet'
+
+# Lower-cased metadata keys that can hold the HUC10 (field 0) or model version (field 1),
+# mapped to (field, priority). Lower priority wins. Keys are matched case-insensitively.
+META_KEYS = {
+    'huc10': (0, 0),
+    'huc': (0, 1),
+    'modelversion': (1, 0),
+    'model_version': (1, 1),
+    'model version': (1, 2),
+}
+
+# (project_type_id, model_version, created day as whole days since the Unix epoch)
+PartitionKey = tuple[str, str, int]
+
+MS_PER_DAY = 86_400_000
+
+# Column-oriented buffer for one partition: PARQUET_SCHEMA field name -> list of values.
+# Rows are never materialised as tuples, and Arrow can build each column straight from its list.
+PartitionColumns = dict[str, list]
+
+# Projects requested per Data Exchange search call. Larger pages mean fewer API round-trips.
+DEFAULT_PAGE_SIZE = 1000
+
+# Number of partition files to upload to S3 concurrently
+UPLOAD_WORKERS = 8
+
+# Most partition files are tiny and go up in a single PUT. Anything large enough to matter
+# is sent as a multipart upload with big parts to keep the number of round-trips down.
+SINGLE_PUT_MAX_BYTES = 5 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=128 * 1024 * 1024,
+    multipart_chunksize=128 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
 
-def scrape_projects_to_sqlite(rs_api: RiverscapesAPI, curs: sqlite3.Cursor, search_params: RiverscapesSearchParams) -> int:
+def scrape_projects_to_partitions(rs_api: RiverscapesAPI, search_params: RiverscapesSearchParams, page_size: int = DEFAULT_PAGE_SIZE) -> dict[PartitionKey, PartitionColumns]:
     """
-    Loop over all the projects that match the search params. Store them in a temporary SQLite database.
-    Then query this database by project type and (UNIQUE) project creation date and create CSV files that
-    are then uploaded to S3 for Athena.
+    Loop over all the projects that match the search params and bucket them by project type, model version
+    and (UNIQUE) project creation date. Each bucket becomes one Parquet file that is then uploaded to S3 for Athena.
+
+    The buckets are only written once the scrape is complete so that each partition is always a single
+    S3 object that a later partial scrape of the same day simply overwrites.
     """
 
-    print('Scraping projects to temporary, in-memory SQLite...')
+    print('Scraping projects into in-memory partitions...')
 
-    for project, _stats, _searchtotal, _prg in rs_api.search(search_params, progress_bar=True, page_size=100):
+    partitions: dict[PartitionKey, PartitionColumns] = defaultdict(_new_partition_columns)
+    for project, _stats, _searchtotal, _prg in rs_api.search(search_params, progress_bar=True, page_size=page_size):
         # Attempt to retrieve the huc10 and model version from the project metadata if it exists
-        huc10 = next((project.project_meta[k] for k in ['HUC10', 'huc10', 'HUC', 'huc'] if k in project.project_meta), None)
-        model_version = next((project.project_meta[k] for k in ['modelVersion', 'model_version', 'Model Version'] if k in project.project_meta), None)
+        huc10, model_version = _get_huc10_and_model_version(project.project_meta)
 
         if huc10 is None:
             print(f'Project {project.id} does not have a HUC10. Skipping...')
@@ -81,105 +142,92 @@ def scrape_projects_to_sqlite(rs_api: RiverscapesAPI, curs: sqlite3.Cursor, sear
             print(f'Project {project.id} does not have a model version. Skipping...')
             continue
 
-        model_version_int = int(model_version.split('.')[0]) * 1000000 + int(model_version.split('.')[1]) * 1000 + int(model_version.split('.')[2])
-
-        # Insert project data
-        # The pipe separating tags is vital. It must correspond wtith the Athena table definition.
-        curs.execute(
-            '''
-            INSERT INTO rs_projects (
-                project_id,
-                name,
-                tags,
-                huc10,
-                model_version,
-                model_version_int,
-                archived,
-                project_type_id,
-                created_on,
-                created_on_date,
-                owned_by_id,
-                owned_by_name,
-                owned_by_type
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (
-                project.id,
-                project.name.replace(',', ' '),
-                '|'.join(project.tags) if project.tags else None,
-                huc10,
-                model_version,
-                model_version_int,
-                1 if project.archived else 0,
-                project.project_type,
-                int(project.created_date.timestamp() * 1000),
-                project.created_date.strftime('%Y-%m-%d %H:%M:%S'),
-                project.json['ownedBy']['id'],
-                project.json['ownedBy']['name'].replace(',', ''),
-                project.json['ownedBy']['__typename'],
-            ),
-        )
-
-    curs.execute('SELECT COUNT(*) FROM rs_projects')
-    total_projects = curs.fetchone()[0]
+        # Split once; anything after the patch number is ignored as before
+        major, minor, patch = model_version.split('.', 3)[:3]
+        model_version_int = int(major) * 1_000_000 + int(minor) * 1_000 + int(patch)
+        created_date = project.created_date
+        created_on = int(created_date.timestamp() * 1000)
+
+        owned_by = project.json['ownedBy']
+        # Integer division gives the UTC day without any date formatting
+        columns = partitions[(project.project_type, model_version, created_on // MS_PER_DAY)]
+        columns['project_id'].append(project.id)
+        columns['name'].append(project.name)
+        columns['tags'].append(project.tags or None)
+        columns['huc10'].append(huc10)
+        columns['model_version_int'].append(model_version_int)
+        columns['archived'].append(1 if project.archived else 0)
+        columns['created_on'].append(created_on)
+        columns['created_on_date'].append(created_date.strftime('%Y-%m-%d %H:%M:%S'))
+        columns['owned_by_id'].append(owned_by['id'])
+        columns['owned_by_name'].append(owned_by['name'])
+        columns['owned_by_type'].append(owned_by['__typename'])
+
+    total_projects = sum(len(columns['project_id']) for columns in partitions.values())
     print(f'Total projects scraped: {total_projects:,}')
-    return total_projects
+    return partitions
+
+
+def _new_partition_columns() -> PartitionColumns:
+    """Create an empty column buffer for a partition"""
+    return {field.name: [] for field in PARQUET_SCHEMA}
+
+
+def _get_huc10_and_model_version(project_meta: dict[str, str]) -> tuple[str | None, str | None]:
+    """Find the HUC10 and model version in a single pass over the project metadata, honouring key priority"""
+    values: list[str | None] = [None, None]
+    ranks = [len(META_KEYS), len(META_KEYS)]
+    meta_keys_get = META_KEYS.get
+    for key, value in project_meta.items():
+        match = meta_keys_get(key.lower())
+        if match is None:
+            continue
+        field, rank = match
+        if rank < ranks[field]:
+            values[field], ranks[field] = value, rank
+            if ranks[0] == 0 and ranks[1] == 0:
+                break
+    return values[0], values[1]
 
 
-def upload_sqlite_to_s3(curs: sqlite3.Cursor, s3_bucket: str) -> None:
-    """Write the contents of the rs_projects table to a temporary CSV file and upload it to S3"""
+def upload_partitions_to_s3(partitions: dict[PartitionKey, PartitionColumns], s3_bucket: str) -> None:
+    """Write each partition to an in-memory Parquet file and upload it to S3"""
 
-    print('Uploading SQLite data to S3...')
+    print('Uploading partitions to S3...')
+    print(f'Total unique project types, model versions and dates: {len(partitions):,}')
     s3 = boto3.client('s3')
 
-    # Get the columns of the rs_projects table
-    curs.execute('PRAGMA table_info(rs_projects)')
-    columns = [col[1] for col in curs.fetchall()]
-
-    # Remove the columns that are not needed for the CSV file because they are partition keys
-    columns.remove('project_type_id')
-    columns.remove('model_version')
-
-    # Store the unique days for each project type. We will create a separate CSV file for
-    # each day and each project type. This should help partition the data better in Athena.
-    curs.execute("""
-        CREATE TEMP TABLE temp_projects AS
-        SELECT DISTINCT 
-            project_type_id,
-            CAST(created_on / 86400000 as INT) * 86400000 create_stamp,
-            date(created_on / 1000, 'unixepoch') create_date,
-            model_version,
-            0 processed
-        FROM rs_projects
-        GROUP BY project_type_id, create_stamp, create_date, model_version""")
-
-    curs.execute('SELECT COUNT(*) FROM temp_projects')
-    total_temp_projects = curs.fetchone()[0]
-    print(f'Total unique project types and dates: {total_temp_projects:,}')
-
-    # curs.execute('SELECT * FROM temp_projects')
-    # rows = curs.fetchall()
-    # print(rows)
-
-    while True:
-        curs.execute("SELECT project_type_id, create_stamp, create_date, model_version FROM temp_projects WHERE processed = 0 LIMIT 1")
-        row = curs.fetchone()
-        if row is None:
-            break
-
-        project_type_id, unique_stamp, unique_date, model_version = row
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.tsv', mode='w', newline='\n', encoding='utf-8') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter='\t', escapechar='\\', quoting=csv.QUOTE_NONE)
-            csvwriter.writerow(columns)
-            for row in curs.execute(f'SELECT {", ".join(columns)} FROM rs_projects WHERE project_type_id = ? AND CAST(created_on / 86400000 as INT) * 86400000 = ?', [project_type_id, unique_stamp]):
-                csvwriter.writerow(row)
-            csvfile.flush()  # Ensure all data is written to the file
-            temp_filename = csvfile.name
-
-        file_key = f'data_exchange/projects/project_type_id={project_type_id}/model_version={model_version}/{unique_date}-{project_type_id}.tsv'
-        s3.upload_file(csvfile.name, s3_bucket, file_key)
-        os.remove(temp_filename)
-        print(f'Upload complete to S3 key: {file_key}')
-        curs.execute("UPDATE temp_projects SET processed = 1 WHERE project_type_id = ? AND create_stamp = ?", [project_type_id, unique_stamp])
+    # The Parquet files are written here on the main thread and only the network-bound uploads are handed to the pool.
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = []
+        for (project_type_id, model_version, created_day), columns in partitions.items():
+            unique_date = datetime.fromtimestamp(created_day * MS_PER_DAY / 1000, tz=UTC).strftime('%Y-%m-%d')
+            buffer = _write_partition_parquet(columns)
+            file_key = f'{S3_PREFIX}/project_type_id={project_type_id}/model_version={model_version}/{unique_date}-{project_type_id}.parquet'
+            futures.append(executor.submit(_upload_partition, s3, buffer, s3_bucket, file_key))
+
+        for future in as_completed(futures):
+            # Re-raise any upload failure
+            future.result()
+
+
+def _write_partition_parquet(columns: PartitionColumns) -> io.BytesIO:
+    """Write the columns of one partition to an in-memory Parquet buffer"""
+    table = pa.Table.from_pydict(columns, schema=PARQUET_SCHEMA)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy', row_group_size=PARQUET_ROW_GROUP_SIZE)
+    return buffer
+
+
+def _upload_partition(s3, buffer: io.BytesIO, s3_bucket: str, file_key: str) -> None:
+    """Upload a single in-memory partition Parquet file to S3. Runs on a worker thread."""
+    if buffer.getbuffer().nbytes < SINGLE_PUT_MAX_BYTES:
+        s3.put_object(Bucket=s3_bucket, Key=file_key, Body=buffer.getvalue())
+    else:
+        # upload_fileobj streams the buffer as a multipart upload using TRANSFER_CONFIG
+        buffer.seek(0)
+        s3.upload_fileobj(buffer, s3_bucket, file_key, Config=TRANSFER_CONFIG)
+    print(f'Upload complete to S3 key: {file_key}')
 
 
 def get_max_existing_athena_date(s3_bucket: str) -> datetime | None:
@@ -211,6 +259,7 @@ def main():
     parser.add_argument('s3_bucket', help='s3 bucket RME files will be placed', type=str)
     parser.add_argument('--tags', help='Data Exchange tags to search for projects', type=str, default='')
     parser.add_argument('--full_scrape', help='Full scrape of all projects, or just new projects', action='store_true', default=False)
+    parser.add_argument('--page_size', help='Number of projects to request per Data Exchange search call', type=int, default=DEFAULT_PAGE_SIZE)
     args = dotenv.parse_args_env(parser)
 
     search_params = RiverscapesSearchParams({})
@@ -228,40 +277,18 @@ def main():
     if args.tags and args.tags != '' and args.tags != '.':
         search_params.tags = args.tags.split(',')
 
-    # Create an in memory SQLite database to store the project data
-    with sqlite3.connect(":memory:") as conn:
-        curs = conn.cursor()
-
-        curs.execute('''CREATE TABLE rs_projects (
-            project_id      TEXT NOT NULL PRIMARY KEY,
-            name            TEXT NOT NULL,
-            project_type_id TEXT NOT NULL,
-            tags            TEXT,
-            huc10           TEXT NOT NULL,
-            model_version   TEXT NOT NULL,
-            model_version_int INTEGER NOT NULL,
-            archived        INTEGER NOT NULL DEFAULT 0,
-            created_on      INTEGER NOT NULL,
-            created_on_date TEXT NOT NULL,
-            owned_by_id     TEXT NOT NULL,
-            owned_by_name   TEXT NOT NULL,
-            owned_by_type   TEXT NOT NULL
-        ) WITHOUT ROWID''')
-
-        curs.execute('CREATE INDEX idx_created_on ON rs_projects (created_on)')
-
-        with RiverscapesAPI(stage=args.stage) as api:
-            total_projects = scrape_projects_to_sqlite(api, curs, search_params)
-            if total_projects == 0:
-                print('No projects found with the specified tags. Exiting...')
-                return
-            upload_sqlite_to_s3(curs, args.s3_bucket)
-
-            # Need to refresh partitions after uploading new data to S3
-            print('Refreshing Athena partitions...')
-            athena_execute(args.s3_bucket, 'MSCK REPAIR TABLE rs_projects')
-
-        print('Process complete')
+    with RiverscapesAPI(stage=args.stage) as api:
+        partitions = scrape_projects_to_partitions(api, search_params, args.page_size)
+        if len(partitions) == 0:
+            print('No projects found with the specified tags. Exiting...')
+            return
+        upload_partitions_to_s3(partitions, args.s3_bucket)
+
+        # Need to refresh partitions after uploading new data to S3
+        print('Refreshing Athena partitions...')
+        athena_execute(args.s3_bucket, 'MSCK REPAIR TABLE rs_projects')
+
+    print('Process complete')
 
 
 if __name__ == '__main__':
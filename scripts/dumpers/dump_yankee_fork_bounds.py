@@ -20,7 +20,9 @@ Philip Bailey
 import json
 import os
 import sqlite3
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
 
 from pydex import RiverscapesAPI
 from pydex.classes.riverscapes_helpers import RiverscapesSearchParams
@@ -28,56 +30,104 @@ from pydex.classes.riverscapes_helpers import RiverscapesSearchParams
 parent_output_dir = "/Users/philipbailey/GISData/champ/yankee_fork_bounds"
 workbench_db_path = "/Users/philipbailey/GISData/riverscapes/champ/workbench.db"
 
-with RiverscapesAPI(stage="production") as api:
-    with sqlite3.connect(workbench_db_path) as sqlite_conn:
-        curs = sqlite_conn.cursor()
-        curs.execute('''
-            CREATE TABLE IF NOT EXISTS CHaMP_Bounds
-            (
-                VisitID INTEGER PRIMARY KEY REFERENCES Visits(VisitID),
-                bounds TEXT,
-                polygon TEXT
-            )
-        ''')
-    for x, _stats, _total, _prg in api.search(
-        RiverscapesSearchParams(
-            {
-                "projectTypeId": "topo",
-                "tags": ["CHAMP_Watershed_Yankee_Fork"],
-            }
-        ),
-        page_size=500,
-    ):
-        site = x.project_meta["Site"]
-        visit_id = int(x.project_meta["Visit"])
-        output_dir = os.path.join(parent_output_dir, site)
-
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir, exist_ok=True)
-            api.download_files(x.id, output_dir, ['project\\.rs\\.xml$', 'project_bounds\\.geojson$'], force=True)
-
-        bounds_file_path = os.path.join(output_dir, 'project_bounds.geojson')
-        bounds_file_json = json.load(open(bounds_file_path, encoding='utf-8')) if os.path.exists(bounds_file_path) else None
-
-        # Load the project.rs.xml to verify it loads correctly.
-        rscontext_path = os.path.join(output_dir, 'project.rs.xml')
-        project = ET.parse(rscontext_path)
-        nod_project = project.find('ProjectBounds')
-        if nod_project is None:
-            continue
 
+def read_project_bounds(rscontext_path: str) -> dict | None:
+    """Read the ProjectBounds centroid and bounding box from a project.rs.xml
+
+    Uses lxml iterparse so parsing stops as soon as the top level ProjectBounds element
+    has been read, rather than building a tree for the whole project file.
+    """
+    for _event, nod_bounds in etree.iterparse(rscontext_path, events=('end',), tag='ProjectBounds'):
+        parent = nod_bounds.getparent()
+        if parent is None or parent.getparent() is not None:
+            # Only the ProjectBounds directly under the root <Project> counts
+            continue
         bounds = {
             'centroid': {
-                'lat': float(nod_project.find('Centroid/Lat').text),
-                'lng': float(nod_project.find('Centroid/Lng').text),
+                'lat': float(nod_bounds.findtext('Centroid/Lat')),
+                'lng': float(nod_bounds.findtext('Centroid/Lng')),
             },
             'boundingBox': {
-                'MinLat': float(nod_project.find('BoundingBox/MinLat').text),
-                'MinLng': float(nod_project.find('BoundingBox/MinLng').text),
-                'MaxLat': float(nod_project.find('BoundingBox/MaxLat').text),
-                'MaxLng': float(nod_project.find('BoundingBox/MaxLng').text),
+                'MinLat': float(nod_bounds.findtext('BoundingBox/MinLat')),
+                'MinLng': float(nod_bounds.findtext('BoundingBox/MinLng')),
+                'MaxLat': float(nod_bounds.findtext('BoundingBox/MaxLat')),
+                'MaxLng': float(nod_bounds.findtext('BoundingBox/MaxLng')),
             },
         }
+        nod_bounds.clear()
+        return bounds
+    return None
+
+
+def parse_site_bounds(visit_id: int, output_dir: str) -> tuple[int, str, str] | None:
+    """Parse the downloaded files for one site into a CHaMP_Bounds row. Runs in a worker process."""
+    bounds_file_path = os.path.join(output_dir, 'project_bounds.geojson')
+    try:
+        with open(bounds_file_path, encoding='utf-8') as f:
+            bounds_file_json = json.load(f)
+    except FileNotFoundError:
+        bounds_file_json = None
+
+    # Load the project.rs.xml to verify it loads correctly.
+    rscontext_path = os.path.join(output_dir, 'project.rs.xml')
+    bounds = read_project_bounds(rscontext_path)
+    if bounds is None:
+        return None
+
+    return visit_id, json.dumps(bounds), json.dumps(bounds_file_json)
+
+
+def main():
+    """Download the Yankee Fork topo project files and load their bounds into the workbench database"""
+    with RiverscapesAPI(stage="production") as api:
+        with sqlite3.connect(workbench_db_path) as sqlite_conn:
+            curs = sqlite_conn.cursor()
+            curs.execute('''
+                CREATE TABLE IF NOT EXISTS CHaMP_Bounds
+                (
+                    VisitID INTEGER PRIMARY KEY REFERENCES Visits(VisitID),
+                    bounds TEXT,
+                    polygon TEXT
+                )
+            ''')
+
+        # One directory scan up front instead of a stat per project
+        os.makedirs(parent_output_dir, exist_ok=True)
+        with os.scandir(parent_output_dir) as entries:
+            existing_sites = {entry.name for entry in entries if entry.is_dir()}
+
+        sites = []
+        for x, _stats, _total, _prg in api.search(
+            RiverscapesSearchParams(
+                {
+                    "projectTypeId": "topo",
+                    "tags": ["CHAMP_Watershed_Yankee_Fork"],
+                }
+            ),
+            page_size=500,
+        ):
+            site = x.project_meta["Site"]
+            visit_id = int(x.project_meta["Visit"])
+            output_dir = os.path.join(parent_output_dir, site)
+
+            if site not in existing_sites:
+                os.makedirs(output_dir, exist_ok=True)
+                existing_sites.add(site)
+                api.download_files(x.id, output_dir, ['project\\.rs\\.xml$', 'project_bounds\\.geojson$'], force=True)
+
+            sites.append((visit_id, output_dir))
+
+        # Parsing is CPU bound and independent per site, so spread it over all cores.
+        # SQLite stays single-writer on this process.
+        visit_ids = [visit_id for visit_id, _output_dir in sites]
+        output_dirs = [output_dir for _visit_id, output_dir in sites]
+        with ProcessPoolExecutor() as pool:
+            rows = [row for row in pool.map(parse_site_bounds, visit_ids, output_dirs, chunksize=16) if row is not None]
+
+        # Insert everything in one transaction rather than one statement per project
+        with sqlite_conn:
+            curs.executemany('INSERT INTO CHaMP_Bounds (VisitID, bounds, polygon) VALUES (?, ?, ?) ON CONFLICT DO NOTHING', rows)
+
 
-        curs.execute('INSERT INTO CHaMP_Bounds (VisitID, bounds, polygon) VALUES (?, ?, ?) ON CONFLICT DO NOTHING', [visit_id, json.dumps(bounds), json.dumps(bounds_file_json)])
-    sqlite_conn.commit()
+if __name__ == '__main__':
+    main()
@@ -4,40 +4,88 @@
 3. upload that to a different prefix in s3
 """
 
+import argparse
+import json
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import boto3
 import geopandas as gpd
-from rme_to_athena_parquet import upload_to_s3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from rsxml import Logger
 from tqdm import tqdm  # trying this instead of ProgressBar, I've heard good things
 
 DEFAULT_DATA_BUCKET = "riverscapes-athena"
 DATA_ROOT = Path(r"F:\nardata\work\rme_extraction")
 
+# Threads only wait on S3 or on the process pool, so there can be more of them than cores.
+# The CPU-bound simplification runs in separate processes so it never contends for the GIL
+# with the threads doing network I/O.
+IO_WORKERS = 12  # ADJUST as needed
+PROCESS_WORKERS = os.cpu_count() or 4
+
+# Lets a single large parquet file transfer in parallel parts
+TRANSFER_CONFIG = TransferConfig(multipart_chunksize=16 * 1024 * 1024, max_concurrency=4)
+
+# Each worker thread keeps its own session and client so the botocore service model is only
+# loaded once per thread and HTTP connections are reused between files
+_thread_local = threading.local()
+
+
+def get_s3_client():
+    """Return the S3 client for the current thread, creating it on first use."""
+    s3 = getattr(_thread_local, 's3', None)
+    if s3 is None:
+        s3 = boto3.session.Session().client('s3', config=Config(max_pool_connections=32, tcp_keepalive=True))
+        _thread_local.s3 = s3
+    return s3
+
 
 def download_s3_file(s3_bucket: str, s3_key: str, local_file_path: Path):
     """Download a file from S3 to a local path."""
-    s3 = boto3.client('s3')
     local_file_path.parent.mkdir(parents=True, exist_ok=True)
-    s3.download_file(s3_bucket, s3_key, str(local_file_path))
+    get_s3_client().download_file(s3_bucket, s3_key, str(local_file_path), Config=TRANSFER_CONFIG)
+
+
+def upload_s3_file(local_file_path: Path, s3_bucket: str, s3_key: str):
+    """Upload a local file to S3."""
+    get_s3_client().upload_file(str(local_file_path), s3_bucket, s3_key, Config=TRANSFER_CONFIG)
 
 
-def list_s3_files(bucket, prefix):
-    """List all S3 object keys in a bucket with the given prefix."""
-    s3 = boto3.client('s3')
+def list_s3_files(bucket, prefix, cache_path: Path | None = None, refresh: bool = False):
+    """List all S3 object keys in a bucket with the given prefix.
+
+    If cache_path is given and exists, the keys are read from it instead of listing S3 again,
+    unless refresh is True. Otherwise the listing is written there so a re-run with the same
+    prefix can skip it. The cache never expires on its own, so files uploaded since it was
+    written are only picked up with refresh.
+    """
+    log = Logger('List S3')
+    if cache_path is not None and cache_path.exists() and not refresh:
+        log.warning(f'Using cached S3 listing {cache_path}. Run with --refresh_listing to pick up new files.')
+        return json.loads(cache_path.read_text(encoding='utf-8'))
+
+    s3 = get_s3_client()
     paginator = s3.get_paginator('list_objects_v2')
     files = []
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        for obj in page.get('Contents', []):
-            files.append(obj['Key'])
+    # 1000 is the largest page list_objects_v2 will return
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+        files.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(json.dumps(files), encoding='utf-8')
     return files
 
 
-def process_one_file(filekey: str, local_folder_downloaded: Path, local_folder_processed: Path, s3_prefix_new: str):
-    """download, process to new file, then upload"""
+def process_one_file(filekey: str, local_folder_downloaded: Path, local_folder_processed: Path, s3_prefix_new: str, process_pool: ProcessPoolExecutor):
+    """download, process to new file (in the process pool), then upload"""
     log = Logger('Process One')
     tqdm.write(f'Processing {filekey}')
     filename = Path(filekey).name
@@ -48,14 +96,14 @@ def process_one_file(filekey: str, local_folder_downloaded: Path, local_folder_p
         log.debug(f'Downloading to {local_file_path_downloaded}')
         download_s3_file(DEFAULT_DATA_BUCKET, filekey, local_file_path_downloaded)
         log.debug(f'Processing to {local_file_path_processed}')
-        process_pq1_to_pq2(local_file_path_downloaded, local_file_path_processed)
+        process_pool.submit(process_pq1_to_pq2, local_file_path_downloaded, local_file_path_processed).result()
         log.debug(f'Uploading to {s3key_new}')
-        upload_to_s3(local_file_path_processed, DEFAULT_DATA_BUCKET, s3key_new)
+        upload_s3_file(local_file_path_processed, DEFAULT_DATA_BUCKET, s3key_new)
     except Exception as e:
         log.error(f"Failed to process {filename}: {e}")
 
 
-def process_multiple(filepattern: str):
+def process_multiple(filepattern: str, refresh_listing: bool = False):
     """process all files starting with filepattern (empty means all files)"""
     log = Logger("Process multiple")
     s3_prefix = 'data_exchange/riverscape_metrics/'
@@ -63,36 +111,59 @@ def process_multiple(filepattern: str):
     local_folder_downloaded = DATA_ROOT / "from-s3-rsathena-data_exchange_rsmetrics"
     local_folder_processed = DATA_ROOT / "to-s3-rsathena-data_exchange_rsmetrics2"
 
-    files = list_s3_files(DEFAULT_DATA_BUCKET, s3_prefix + filepattern)
+    # Pass --refresh_listing (or delete this file) to force a fresh listing of the bucket
+    listing_cache = DATA_ROOT / f"s3_listing_{filepattern or 'all'}.json"
+    files = list_s3_files(DEFAULT_DATA_BUCKET, s3_prefix + filepattern, listing_cache, refresh_listing)
     log.info(f'Found {len(files)} files matching pattern {filepattern}')
-    with ThreadPoolExecutor(max_workers=12) as executor:  # ADJUST as needed
-        futures = [executor.submit(process_one_file, filekey, local_folder_downloaded, local_folder_processed, s3_prefix_new) for filekey in files]
+    # While one file is being simplified in the process pool, other threads keep downloading
+    # and uploading, so network and CPU work overlap.
+    with ProcessPoolExecutor(max_workers=PROCESS_WORKERS) as process_pool, ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+        futures = [executor.submit(process_one_file, filekey, local_folder_downloaded, local_folder_processed, s3_prefix_new, process_pool) for filekey in files]
         for _ in tqdm(as_completed(futures), total=len(futures)):
             pass  # Optionally handle results or exceptions here
 
 
 def process_pq1_to_pq2(inputpqpath: Path, outputpqpath: Path, tolerance: float = 11):
-    """take a geo-parquet file, add a simplified geometry column, save back to new geo-parquet file"""
-    gdf = gpd.read_parquet(inputpqpath)
-
-    # Reproject to EPSG:5070 for simplification
-    gdf_proj = gdf.to_crs(epsg=5070)
-
-    # Use simplify_coverage for topology-preserving simplification
-    gdf["geometry_simplified"] = gdf_proj.geometry.simplify_coverage(tolerance=tolerance)
-    # Reproject simplified geometry back to EPSG:4326
-    gdf["geometry_simplified"] = gpd.GeoSeries(gdf["geometry_simplified"], crs=5070).to_crs(epsg=4326)
-    gdf = gdf.set_crs(epsg=4326)
-    gdf = gdf.reset_index(drop=True)
-    gdf.to_parquet(outputpqpath)
+    """take a geo-parquet file, add a simplified geometry column, save back to new geo-parquet file
+
+    Only the geometry column is decoded into shapely objects. The attribute columns stay as Arrow
+    arrays and are written back out without ever being converted to pandas.
+    """
+    table = pq.read_table(inputpqpath)
+    geo_meta = json.loads(table.schema.metadata[b'geo'])
+    geom_col = geo_meta['primary_column']
+    geom_meta = geo_meta['columns'][geom_col]
+    if geom_meta.get('encoding', 'WKB').upper() != 'WKB':
+        raise ValueError(f"Unsupported geometry encoding {geom_meta['encoding']} in {inputpqpath}")
+
+    # A missing crs means OGC:CRS84 in the GeoParquet spec
+    geoms = gpd.GeoSeries.from_wkb(table.column(geom_col).to_numpy(zero_copy_only=False), crs=geom_meta.get('crs', 'OGC:CRS84'))
+
+    # Use simplify_coverage for topology-preserving simplification in EPSG:5070.
+    # The coverage has to be simplified as a whole, so this can't be done one row group at a time.
+    simplified = geoms.to_crs(epsg=5070).simplify_coverage(tolerance=tolerance).to_crs(epsg=4326)
+
+    table = table.append_column(pa.field('geometry_simplified', pa.binary()), pa.array(simplified.to_wkb(), type=pa.binary()))
+    geo_meta['columns']['geometry_simplified'] = {
+        'encoding': 'WKB',
+        'geometry_types': sorted(set(simplified.geom_type.dropna())),
+        'crs': simplified.crs.to_json_dict(),
+    }
+    table = table.replace_schema_metadata({**table.schema.metadata, b'geo': json.dumps(geo_meta).encode('utf-8')})
+    # zstd gives smaller files than the default snappy for a quicker upload
+    pq.write_table(table, outputpqpath, compression='zstd', compression_level=3)
 
 
 def main():
     """Main entry point"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--refresh_listing', help='List the S3 bucket again instead of using the cached listing from a previous run', action='store_true', default=False)
+    args = parser.parse_args()
+
     log = Logger('Setup')
     log.setup(log_path=str(DATA_ROOT / 'add_simplified_geom.log'), log_level=logging.INFO)
     log.title('Add simplified geometry')
-    process_multiple('rme')
+    process_multiple('rme', args.refresh_listing)
     log.title('Completed.')
 
 
@@ -8,19 +8,26 @@ June 2025
 
 import argparse
 import csv
+import gzip
 import logging
 import os
 import re
 import shutil
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
 
 import apsw
 import boto3
 import geopandas as gpd
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 from rsxml import Logger, ProgressBar, dotenv
 from rsxml.util import safe_makedirs
 
 from pydex import RiverscapesAPI, RiverscapesSearchParams
 from pydex.classes.riverscapes_helpers import RiverscapesProject
+from pydex.lib.files import scan_files
 
 # RegEx for finding RME output GeoPackages
 RME_SCRAPE_GPKG_REGEX = r'.*riverscapes_metrics.gpkg'
@@ -34,94 +41,166 @@ FULL_FLOAT_COLS = ['latitude', 'longitude', 'prim_channel_gradient']
 MAJOR = 1000000
 MINOR = 1000
 
+# Simplification is CPU bound, so run one HUC per core.
+PROCESS_WORKERS = os.cpu_count() or 4
+# Cap on downloaded HUCs waiting for or being processed by a worker
+MAX_HUCS_IN_FLIGHT = 2 * PROCESS_WORKERS
+
+# Bytes of each GeoPackage SQLite may memory-map during the huc12 join
+MMAP_SIZE = 30_000_000_000
+
+# Concurrent huc12 TSV uploads per worker
+TRANSFER_CONFIG = TransferConfig(max_concurrency=16, multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+
 
 def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: RiverscapesSearchParams, download_dir: str, s3_bucket: str, delete_downloads: bool, tolerance: float) -> None:
     """
-    Loop over all the projects, download the RME and RCAT output GeoPackages, and scrape the statistics
+    Loop over all the projects, download the RME output GeoPackages and hand each one to a worker process
+    that simplifies the DGO geometries and uploads the huc12 TSVs.
+
+    The search and downloads stay on the main thread. The number of HUCs in flight is capped so the
+    downloads can't get too far ahead of the workers and fill up the download folder.
     """
 
     log = Logger('Merge RME Scrapes')
-    s3 = boto3.client('s3')
 
     # Build a list of existing RME runs that are stored in Athena.
     # results = athena_query(s3_bucket, 'SELECT DISTINCT watershed_id, rme_date_created_ts FROM raw_rme')
     # existing_rme = {row['Data'][0]['VarCharValue']: int(row['Data'][1]['VarCharValue']) for row in results[1:]}
 
-    # Create a timedelta object with a difference of 1 day
     count = 0
-    for project, _stats, _searchtotal, prg in rs_api.search(search_params, progress_bar=True, page_size=100):
-        project: RiverscapesProject
-        prg: ProgressBar
-
-        if project.huc is None or project.huc == '':
-            log.warning(f'Project {project.id} does not have a HUC. Skipping.')
-            continue
-
-        # check whether the project is already in Athena with the same or newer date
-        # project_created_date_ts = int(project.created_date.timestamp()) * 1000
-        # if project.huc in existing_rme and existing_rme[project.huc] <= project_created_date_ts:
-        #     log.info(f'Skipping project {project.id} as it is already in Athena with the same or newer date.')
-        #     continue
-
-        if project.model_version is None:
-            log.warning(f'Project {project.id} does not have a model version. Skipping.')
-            continue
-
-        model_version_int = project.model_version.major * MAJOR + project.model_version.minor * MINOR + project.model_version.patch
-
-        try:
-            huc_dir = os.path.join(download_dir, project.huc)
-            safe_makedirs(huc_dir)
-            rme_gpkg = download_file(rs_api, project.id, huc_dir, RME_SCRAPE_GPKG_REGEX)
-            # rme_tsv = os.path.join(huc_dir, f'rme_{project.huc}.tsv')
-            # s3_key = os.path.join('rme', 'raw', os.path.basename(rme_tsv))
-
-            # Simplify the DGO geometries in the GeoPackage
-            simplified_gpkg = os.path.join(huc_dir, f'simplified_dgos_{project.huc}.gpkg')
-            simplify_dgo_geometries(rme_gpkg, simplified_gpkg, tolerance)
-
-            conn = apsw.Connection(simplified_gpkg)
-            conn.enable_load_extension(True)
-            conn.load_extension(spatialite_path)
-
-            conn.execute(f"ATTACH DATABASE '{rme_gpkg}' AS rme")
-
-            # Get a list of the distinct HUC12 in this GeoPackage
-            curs = conn.cursor()
-            curs.execute('SELECT DISTINCT huc12 FROM rme.dgo_desc')
-            huc12s = [row[0] for row in curs.fetchall()]
-
-            for huc12 in huc12s:
-                huc12_tsv = os.path.join(huc_dir, f'rme_{huc12}.tsv')
+    with ProcessPoolExecutor(max_workers=PROCESS_WORKERS) as pool:
+        futures: dict[Future, str] = {}
+
+        def collect(done: set[Future]) -> None:
+            nonlocal count
+            for future in done:
+                huc = futures.pop(future)
+                try:
+                    future.result()
+                    count += 1
+                    prg.update(count)
+                except Exception as e:
+                    log.error(f'Error scraping HUC {huc}: {e}')
+
+        for project, _stats, _searchtotal, prg in rs_api.search(search_params, progress_bar=True, page_size=100):
+            project: RiverscapesProject
+            prg: ProgressBar
+
+            if project.huc is None or project.huc == '':
+                log.warning(f'Project {project.id} does not have a HUC. Skipping.')
+                continue
+
+            # check whether the project is already in Athena with the same or newer date
+            # project_created_date_ts = int(project.created_date.timestamp()) * 1000
+            # if project.huc in existing_rme and existing_rme[project.huc] <= project_created_date_ts:
+            #     log.info(f'Skipping project {project.id} as it is already in Athena with the same or newer date.')
+            #     continue
+
+            if project.model_version is None:
+                log.warning(f'Project {project.id} does not have a model version. Skipping.')
+                continue
+
+            # Several projects can share a HUC, so each gets its own folder that no other worker touches
+            project_dir = os.path.join(download_dir, project.huc, project.id)
+            try:
+                safe_makedirs(project_dir)
+                rme_gpkg = download_file(rs_api, project.id, project_dir, RME_SCRAPE_GPKG_REGEX)
+            except Exception as e:
+                log.error(f'Error downloading HUC {project.huc}: {e}')
+                if delete_downloads is True:
+                    delete_download_dir(project_dir)
+                continue
+
+            # Projects for the same HUC upload to the same huc12 keys. Let any earlier one finish first
+            # so the last project in search order always wins, as it did when the HUCs ran one at a time.
+            same_huc = {future for future, huc in futures.items() if huc == project.huc}
+            if same_huc:
+                collect(wait(same_huc).done)
+
+            futures[pool.submit(process_huc, spatialite_path, rme_gpkg, project_dir, project.huc, s3_bucket, tolerance, delete_downloads)] = project.huc
+            if len(futures) >= MAX_HUCS_IN_FLIGHT:
+                done, _pending = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(set(as_completed(futures)))
+
+
+def process_huc(spatialite_path: str, rme_gpkg: str, project_dir: str, huc: str, s3_bucket: str, tolerance: float, delete_downloads: bool) -> None:
+    """
+    Simplify the DGO geometries of one downloaded RME GeoPackage and upload one TSV per huc12 to S3.
+    Runs in a worker process, so it only takes picklable arguments and creates its own S3 client.
+    """
+
+    s3 = boto3.client('s3')
+    try:
+        # Simplify the DGO geometries in the GeoPackage
+        simplified_gpkg = os.path.join(project_dir, f'simplified_dgos_{huc}.gpkg')
+        simplify_dgo_geometries(rme_gpkg, simplified_gpkg, tolerance)
+
+        conn = apsw.Connection(simplified_gpkg)
+        conn.enable_load_extension(True)
+        conn.load_extension(spatialite_path)
+
+        conn.execute(f"ATTACH DATABASE '{rme_gpkg}' AS rme")
+
+        # Memory-map both GeoPackages for the join. Only the simplified table, which this script just wrote,
+        # is analyzed. The downloaded RME GeoPackage is a read-only input, so no statistics are written into it.
+        conn.execute(f'PRAGMA main.mmap_size={MMAP_SIZE}')
+        conn.execute(f'PRAGMA rme.mmap_size={MMAP_SIZE}')
+        conn.execute('ANALYZE main.simplified_dgos')
+
+        # One query for the whole GeoPackage, sorted by huc12, instead of repeating the join once per huc12.
+        # Rows are split into one TSV per huc12 as the sorted results stream past.
+        curs = conn.cursor()
+        curs.execute(
+            '''SELECT dd.huc12, d.level_path, d.seg_distance, st_astext(CastAutomagic(d.geom)) geom
+                     FROM simplified_dgos d
+                     inner join rme.dgos rmed on d.level_path = rmed.level_path and d.seg_distance = rmed.seg_distance
+                     inner join rme.dgo_desc dd on rmed.dgoid = dd.dgoid
+                     WHERE dd.huc12 IS NOT NULL
+                     ORDER BY dd.huc12'''
+        )
+
+        # Uploads run in the background on the transfer manager's threads while the next huc12 TSV is written.
+        # Leaving the block waits for (or, on error, cancels) every upload before the TSVs can be deleted.
+        with create_transfer_manager(s3, TRANSFER_CONFIG) as transfer:
+            uploads = []
+            for huc12, rows in groupby(curs, key=itemgetter(0)):
+                huc12_tsv = os.path.join(project_dir, f'rme_{huc12}.tsv.gz')
                 s3_key = os.path.join('rme', 'huc12-geom-cartography', os.path.basename(huc12_tsv))
 
-                curs.execute(
-                    '''SELECT d.level_path, d.seg_distance, st_astext(CastAutomagic(d.geom)) geom
-                             FROM simplified_dgos d 
-                             inner join rme.dgos rmed on d.level_path = rmed.level_path and d.seg_distance = rmed.seg_distance
-                             inner join rme.dgo_desc dd on rmed.dgoid = dd.dgoid
-                             WHERE dd.huc12 = ?''',
-                    [huc12],
-                )
-                with open(huc12_tsv, "w", newline='', encoding="utf-8") as f:
+                # The rows stream straight from SQLite, so the WKT for a whole huc12 is never held in memory at once.
+                # WKT compresses very well, and Athena reads .gz text files transparently. Level 1 keeps gzip cheap.
+                with gzip.open(huc12_tsv, "wt", newline='', encoding="utf-8", compresslevel=1) as f:
                     writer = csv.writer(f, delimiter="\t")
                     writer.writerow(['level_path', 'seg_distance', 'geom'])
-                    for row in curs.fetchall():
-                        writer.writerow(row)
+                    writer.writerows(row[1:] for row in rows)
 
-                s3.upload_file(huc12_tsv, s3_bucket, s3_key)
-            count += 1
-            prg.update(count)
+                uploads.append((transfer.upload(huc12_tsv, s3_bucket, s3_key, extra_args={'ContentType': 'application/gzip'}), s3_key))
 
-        except Exception as e:
-            log.error(f'Error scraping HUC {project.huc}: {e}')
+            for upload, s3_key in uploads:
+                # Re-raise any upload failure
+                upload.result()
+                # Remove any uncompressed TSV left by an earlier scrape of this huc12 so Athena doesn't read it twice.
+                # S3 treats deleting a key that doesn't exist as a success.
+                s3.delete_object(Bucket=s3_bucket, Key=s3_key.removesuffix('.gz'))
+        conn.close()
+    finally:
+        if delete_downloads is True:
+            delete_download_dir(project_dir)
 
-        if delete_downloads is True and os.path.isdir(huc_dir):
-            try:
-                log.info(f'Deleting download directory {huc_dir}')
-                shutil.rmtree(huc_dir)
-            except Exception as e:
-                log.error(f'Error deleting download directory {huc_dir}: {e}')
+
+def delete_download_dir(project_dir: str) -> None:
+    """Delete a project download directory, logging rather than raising on failure"""
+    log = Logger('Merge RME Scrapes')
+    if not os.path.isdir(project_dir):
+        return
+    try:
+        log.info(f'Deleting download directory {project_dir}')
+        shutil.rmtree(project_dir)
+    except Exception as e:
+        log.error(f'Error deleting download directory {project_dir}: {e}')
 
 
 def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, regex: str) -> str:
@@ -131,7 +210,7 @@ def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, re
     """
 
     gpkg_path = get_matching_file(download_dir, regex)
-    if gpkg_path is not None and os.path.isfile(gpkg_path):
+    if gpkg_path is not None:
         return gpkg_path
 
     rs_api.download_files(project_id, download_dir, [regex])
@@ -139,7 +218,7 @@ def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, re
     gpkg_path = get_matching_file(download_dir, regex)
 
     # Cannot proceed with this HUC if the output GeoPackage is missing
-    if gpkg_path is None or not os.path.isfile(gpkg_path):
+    if gpkg_path is None:
         raise FileNotFoundError(f'Could not find output GeoPackage in {download_dir}')
 
     return gpkg_path
@@ -153,27 +232,35 @@ def get_matching_file(parent_dir: str, regex: str) -> str:
     to avoid downloading it again.
     """
 
-    regex = re.compile(regex)
-    for root, __dirs, files in os.walk(parent_dir):
-        for file_name in files:
-            # Check if the file name matches the regex
-            if regex.match(file_name):
-                return os.path.join(root, file_name)
+    pattern = _compile_regex(regex)
+    for entry in scan_files(parent_dir):
+        # scan_files only yields files, so a matching name is all that needs checking
+        if pattern.match(entry.name):
+            return entry.path
 
     return None
 
 
+@lru_cache(maxsize=32)
+def _compile_regex(regex: str) -> re.Pattern:
+    """Compile a file name regex once, however many projects it is checked against"""
+    return re.compile(regex)
+
+
 def simplify_dgo_geometries(gpkg_path: str, output_path: str, tolerance: int) -> None:
     """
     Simplify the DGO geometries in the GeoPackage using a specified tolerance.
     The simplified geometries are saved to the output path.
+
+    Only the columns needed to join back to the RME DGOs are read, through pyogrio's Arrow reader.
+    simplify_coverage is kept so that neighbouring DGOs still share their edges after simplification.
     """
 
-    gdf = gpd.read_file(gpkg_path, layer='dgos')
-    gdf = gdf.to_crs(epsg=5070)  # Reproject to EPSG:5070 so we can use linear tolerance
-    gdf["geometry"] = gdf.geometry.simplify_coverage(tolerance=tolerance)
-    gdf = gdf.to_crs(epsg=4326)
-    gdf.to_file(output_path, driver="GPKG", layer='simplified_dgos')
+    gdf = gpd.read_file(gpkg_path, layer='dgos', columns=['level_path', 'seg_distance'], engine='pyogrio', use_arrow=True)
+    # Reproject to EPSG:5070 so we can use linear tolerance
+    simplified = gdf.geometry.to_crs(epsg=5070).simplify_coverage(tolerance=tolerance)
+    gdf = gdf.set_geometry(simplified.to_crs(epsg=4326))
+    gdf.to_file(output_path, driver="GPKG", layer='simplified_dgos', engine='pyogrio')
 
 
 def main():
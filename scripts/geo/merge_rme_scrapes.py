@@ -23,6 +23,9 @@ from pydex import RiverscapesAPI, RiverscapesSearchParams
 # RegEx for finding RME and RCAT output GeoPackages
 RME_SCRAPE_GPKG_REGEX = r'.*rme_scrape\.sqlite'
 
+# Rows copied per executemany call when copying a table between databases
+COPY_BATCH_SIZE = 10_000
+
 
 def merge_rme_scrapes(rs_api: RiverscapesAPI, search_params: RiverscapesSearchParams, download_dir: str, output_curs: sqlite3.Cursor, delete_downloads: bool) -> None:
     """
@@ -116,23 +119,23 @@ def copy_table_between_cursors(src_cursor, dest_cursor, table_name, create_table
 
     if create_table is True:
         # Get table schema from the source database
-        src_cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}'")
+        src_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", [table_name])
         create_table_sql = src_cursor.fetchone()[0]
         dest_cursor.execute(create_table_sql)
 
-    # Get all data from the source table
-    src_cursor.execute(f"SELECT * FROM {table_name}")
-    rows = src_cursor.fetchall()
-
     # Get the column names from the source table
-    src_cursor.execute(f"PRAGMA table_info({table_name})")
+    src_cursor.execute(f'PRAGMA table_info("{table_name}")')
     columns = [info[1] for info in src_cursor.fetchall()]  # info[1] gives the column names
-    columns_str = ', '.join(columns)
+    columns_str = ', '.join(f'"{col}"' for col in columns)
 
-    # Insert data into the destination table
+    # Insert data into the destination table in batches straight from the source cursor,
+    # so the whole table is never held in memory. The inserts all go into the destination
+    # connection's open transaction, which the caller commits.
     placeholders = ', '.join(['?' for _ in columns])  # Create placeholders for SQL insert
-    insert_sql = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders})"
-    dest_cursor.executemany(insert_sql, rows)
+    insert_sql = f'INSERT INTO "{table_name}" ({columns_str}) VALUES ({placeholders})'
+    src_cursor.execute(f'SELECT {columns_str} FROM "{table_name}"')
+    while batch := src_cursor.fetchmany(COPY_BATCH_SIZE):
+        dest_cursor.executemany(insert_sql, batch)
 
 
 def create_output_db(output_db: str, delete: bool) -> None:
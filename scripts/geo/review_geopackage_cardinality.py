@@ -4,10 +4,15 @@ run something on each one, and report what we find
 
 import os
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import PurePath
 
 import pandas as pd
 from rsxml import ProgressBar
 
+from pydex.lib.files import scan_files
+from pydex.lib.sqlite import tune_for_reading
+
 # Configuration
 ROOT_DIR = r"F:\nardata\work\rme_extraction\rme-athena\downloads"
 GPKG_NAME = "riverscapes_metrics.gpkg"
@@ -17,17 +22,13 @@ OUTPUT_CSV = "gpkg_cardinality_report.csv"
 
 def find_files_matching_name(root_dir, file_name):
     """return list of paths for all files matching file_name in root_dir and all subdirectories"""
-    gpkg_files = []
-    for dirpath, _, files in os.walk(root_dir):
-        if file_name in files:
-            gpkg_files.append(os.path.join(dirpath, file_name))
-    return gpkg_files
+    return [entry.path for entry in scan_files(root_dir) if entry.name == file_name]
 
 
 def get_grandparent_id(gpkg_path):
     """get the name of the path's grandparent folder"""
     # e.g. `...\1002000101\outputs\riverscapes_metrics.gpkg` -> 1002000101
-    return os.path.basename(os.path.dirname(os.path.dirname(gpkg_path)))
+    return PurePath(gpkg_path).parents[1].name
 
 
 def get_spatialite_path():
@@ -43,6 +44,7 @@ def connect_with_spatialite(gpkg_path):
         conn.load_extension(spatialite_path)
     else:
         raise FileNotFoundError(f'Could not find {spatialite_path}')
+    tune_for_reading(conn)
     return conn
 
 
@@ -51,12 +53,18 @@ def measure_table_counts(gpkg_path, tables):
     try:
         conn = connect_with_spatialite(gpkg_path)
         cur = conn.cursor()
-        for table in tables:
-            try:
-                cur.execute(f"SELECT COUNT(*) FROM {table}")
-                counts[table] = cur.fetchone()[0]
-            except Exception:
-                counts[table] = None
+        try:
+            # All the counts in one statement
+            cur.execute("SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {table})" for table in tables))
+            counts = dict(zip(tables, cur.fetchone(), strict=True))
+        except sqlite3.OperationalError:
+            # At least one table is missing, so count them one at a time to find out which
+            for table in tables:
+                try:
+                    cur.execute(f"SELECT COUNT(*) FROM {table}")
+                    counts[table] = cur.fetchone()[0]
+                except Exception:
+                    counts[table] = None
         conn.close()
     except Exception:
         counts = {table: None for table in tables}
@@ -64,20 +72,18 @@ def measure_table_counts(gpkg_path, tables):
 
 
 def count_dgos_polygons(gpkg_path):
-    """count of records for our dgos selection query"""
+    """count of records for our dgos selection query
+
+    The selection query unions the polygons of each level_path/seg_distance group, but only the
+    number of groups matters here, so no geometry is touched and SpatiaLite isn't needed.
+    """
     try:
-        conn = connect_with_spatialite(gpkg_path)
+        conn = sqlite3.connect(gpkg_path)
+        tune_for_reading(conn)
         cur = conn.cursor()
         cur.execute("""
             SELECT COUNT(*) FROM (
-                    SELECT
-                    dgoid,
-                    st_union(CastAutomagic(dgos.geom)) dgo_geom,
-                    level_path,
-                    seg_distance,
-                    centerline_length,
-                    segment_area,
-                    FCode
+                SELECT 1
                 FROM dgos
                 GROUP BY level_path, seg_distance
             )
@@ -100,6 +106,7 @@ def measure_table_cardinality(gpkg_path: str) -> dict:
 
 def find_duplicate_lp_segdist(gpkg_path: str) -> dict:
     conn = sqlite3.connect(gpkg_path)
+    tune_for_reading(conn)
     cur = conn.cursor()
     cur.execute("""
         WITH dupes AS (
@@ -117,18 +124,24 @@ def find_duplicate_lp_segdist(gpkg_path: str) -> dict:
     return {'hasduplicate': has_dupes}
 
 
+def scan_gpkg(gpkg_path: str) -> dict:
+    """Report for a single GeoPackage. Runs in a worker process, which opens its own connections."""
+    id_ = get_grandparent_id(gpkg_path)
+    result = measure_table_cardinality(gpkg_path)
+    # result = find_duplicate_lp_segdist(gpkg_path)
+    return {"id": id_, **result}
+
+
 def main():
     gpkg_files = find_files_matching_name(ROOT_DIR, GPKG_NAME)
+    gpkg_files = gpkg_files[:101]  # just sample
     results = []
     _prg = ProgressBar(len(gpkg_files), 50, 'File progress')
-    for i, gpkg_path in enumerate(gpkg_files):
-        _prg.update(i)
-        id_ = get_grandparent_id(gpkg_path)
-        result = measure_table_cardinality(gpkg_path)
-        # result = find_duplicate_lp_segdist(gpkg_path)
-        results.append({"id": id_, **result})
-        if i == 100:  # just sample
-            break
+    # Each GeoPackage is independent, so scan them in parallel. map keeps the results in file order.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for i, result in enumerate(executor.map(scan_gpkg, gpkg_files, chunksize=4)):
+            results.append(result)
+            _prg.update(i + 1)
     _prg.finish()
     # Write to CSV
     df = pd.DataFrame(results)
@@ -2,19 +2,16 @@
 
 import os
 
-import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 
 folder = r"C:\nardata\work\rme_extraction\rme-athena\downloads\1012010302"
 folder = r"C:\nardata\localcode\data-exchange-scripts\inputs"
-schemas = {}
 
-for filename in os.listdir(folder):
-    if filename.endswith(".parquet"):
-        path = os.path.join(folder, filename)
-        schema = pq.read_schema(path)
-        schemas[filename] = schema
+# pyarrow reads the parquet footers itself rather than one pq.read_schema call per file
+paths = sorted(entry.path for entry in os.scandir(folder) if entry.name.endswith(".parquet"))
+dataset = ds.dataset(paths, format='parquet')
 
 # Compare schemas
-for fname, schema in schemas.items():
-    print(f"\n{fname} schema:")
-    print(schema)
+for fragment in dataset.get_fragments():
+    print(f"\n{os.path.basename(fragment.path)} schema:")
+    print(fragment.physical_schema)
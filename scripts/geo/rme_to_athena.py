@@ -8,6 +8,7 @@ June 2025
 
 import argparse
 import csv
+import gzip
 import logging
 import os
 import re
@@ -21,6 +22,8 @@ from rsxml.util import safe_makedirs
 from pydex import RiverscapesAPI, RiverscapesSearchParams
 from pydex.classes.riverscapes_helpers import RiverscapesProject
 from pydex.lib.athena import athena_query
+from pydex.lib.files import scan_files
+from pydex.lib.sqlite import tune_for_reading
 
 # RegEx for finding RME output GeoPackages
 RME_SCRAPE_GPKG_REGEX = r'.*riverscapes_metrics.gpkg'
@@ -35,7 +38,7 @@ MAJOR = 1000000
 MINOR = 1000
 
 
-def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: RiverscapesSearchParams, download_dir: str, s3_bucket: str, delete_downloads: bool) -> None:
+def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: RiverscapesSearchParams, download_dir: str, s3_bucket: str, delete_downloads: bool, huc_filter: str = '') -> None:
     """
     Loop over all the projects, download the RME output GeoPackage, and scrape the geometries and metrics.
     """
@@ -43,9 +46,15 @@ def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: Rive
     log = Logger('Merge RME Scrapes')
     s3 = boto3.client('s3')
 
-    # Build a list of existing RME runs that are stored in Athena.
-    results = athena_query(s3_bucket, 'SELECT DISTINCT watershed_id, rme_date_created_ts FROM raw_rme')
-    existing_rme = {row['Data'][0]['VarCharValue']: int(row['Data'][1]['VarCharValue']) for row in results[1:]}
+    # Build a list of existing RME runs that are stored in Athena, limited to the HUCs being scraped.
+    # Athena collapses repeat runs of a HUC to the latest one.
+    where = ''
+    if huc_filter:
+        huc_filter_sql = huc_filter.replace("'", "''")
+        where = f" WHERE watershed_id LIKE '{huc_filter_sql}'"
+    results = athena_query(s3_bucket, f'SELECT watershed_id, MAX(rme_date_created_ts) FROM raw_rme{where} GROUP BY watershed_id')
+    # athena_query returns None when there are no rows
+    existing_rme = {row['Data'][0]['VarCharValue']: int(row['Data'][1]['VarCharValue']) for row in (results or [])[1:]}
 
     count = 0
     for project, _stats, _searchtotal, prg in rs_api.search(search_params, progress_bar=True, page_size=100):
@@ -58,8 +67,9 @@ def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: Rive
 
         # check whether the project is already in Athena with the same or newer date
         project_created_date_ts = int(project.created_date.timestamp()) * 1000
-        if project.huc in existing_rme and existing_rme[project.huc] <= project_created_date_ts:
-            log.info(f'Skipping project {project.id} as it is already in Athena with the same or newer date. DEX ts = {project_created_date_ts}; Athena ts={int(project.created_date.timestamp()) * 1000}.')
+        athena_ts = existing_rme.get(project.huc)
+        if athena_ts is not None and athena_ts <= project_created_date_ts:
+            log.info(f'Skipping project {project.id} as it is already in Athena with the same or newer date. DEX ts = {project_created_date_ts}; Athena ts={athena_ts}.')
             continue
 
         if project.model_version is None:
@@ -72,12 +82,14 @@ def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: Rive
             huc_dir = os.path.join(download_dir, project.huc)
             safe_makedirs(huc_dir)
             rme_gpkg = download_file(rs_api, project.id, huc_dir, RME_SCRAPE_GPKG_REGEX)
-            rme_tsv = os.path.join(huc_dir, f'rme_{project.huc}.tsv')
+            rme_tsv = os.path.join(huc_dir, f'rme_{project.huc}.tsv.gz')
             s3_key = os.path.join('rme', 'raw', os.path.basename(rme_tsv))
 
             conn = apsw.Connection(rme_gpkg)
             conn.enable_load_extension(True)
             conn.load_extension(spatialite_path)
+            # The metrics join and the dgos GROUP BY read the whole GeoPackage once
+            tune_for_reading(conn)
 
             def dict_row_factory(cursor, row):
                 return {description[0]: value for description, value in zip(cursor.getdescription(), row)}
@@ -115,7 +127,7 @@ def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: Rive
                     (
                          SELECT
                             dgoid,
-                            st_union(CastAutomagic(dgos.geom)) dgo_geom,
+                            ST_UnaryUnion(ST_Collect(CastAutomagic(dgos.geom))) dgo_geom,
                             level_path,
                             seg_distance,
                             centerline_length,
@@ -130,13 +142,15 @@ def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: Rive
                 [str(project.model_version), model_version_int, project_created_date_ts],
             )
 
-            with open(rme_tsv, "w", newline='', encoding="utf-8") as f:
+            # Gzip level 1 keeps compression cheap. Athena reads .gz text files transparently.
+            with gzip.open(rme_tsv, "wt", newline='', encoding="utf-8", compresslevel=1) as f:
                 writer = csv.writer(f, delimiter="\t")
                 cols = [description[0] for description in curs.description]
                 # remove any columns called DGOID
                 cols = [col for col in cols if col.lower() != 'dgoid']
                 writer.writerow(cols)
-                for row in curs.fetchall():
+                # Iterate the cursor so rows are written as SQLite produces them, rather than all held in memory
+                for row in curs:
                     values = []
                     for col in cols:
                         value = row[col]
@@ -154,7 +168,10 @@ def scrape_rme(rs_api: RiverscapesAPI, spatialite_path: str, search_params: Rive
                             values.append(str(value))
                     writer.writerow(values)
 
-            s3.upload_file(rme_tsv, s3_bucket, s3_key)
+            s3.upload_file(rme_tsv, s3_bucket, s3_key, ExtraArgs={'ContentType': 'application/gzip'})
+            # Remove any uncompressed TSV left by an earlier scrape of this HUC so Athena doesn't read it twice.
+            # S3 treats deleting a key that doesn't exist as a success.
+            s3.delete_object(Bucket=s3_bucket, Key=s3_key.removesuffix('.gz'))
             count += 1
             prg.update(count)
 
@@ -176,7 +193,7 @@ def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, re
     """
 
     gpkg_path = get_matching_file(download_dir, regex)
-    if gpkg_path is not None and os.path.isfile(gpkg_path):
+    if gpkg_path is not None:
         return gpkg_path
 
     rs_api.download_files(project_id, download_dir, [regex])
@@ -184,7 +201,7 @@ def download_file(rs_api: RiverscapesAPI, project_id: str, download_dir: str, re
     gpkg_path = get_matching_file(download_dir, regex)
 
     # Cannot proceed with this HUC if the output GeoPackage is missing
-    if gpkg_path is None or not os.path.isfile(gpkg_path):
+    if gpkg_path is None:
         raise FileNotFoundError(f'Could not find output GeoPackage in {download_dir}')
 
     return gpkg_path
@@ -199,11 +216,10 @@ def get_matching_file(parent_dir: str, regex: str) -> str:
     """
 
     regex = re.compile(regex)
-    for root, __dirs, files in os.walk(parent_dir):
-        for file_name in files:
-            # Check if the file name matches the regex
-            if regex.match(file_name):
-                return os.path.join(root, file_name)
+    for entry in scan_files(parent_dir):
+        # Check if the file name matches the regex. The DirEntry already knows it is a file.
+        if regex.match(entry.name):
+            return entry.path
 
     return None
 
@@ -246,11 +262,13 @@ def main():
     if args.tags is not None and args.tags != '.':
         search_params.tags = args.tags.split(',')
 
+    huc_filter = ''
     if args.huc_filter != '' and args.huc_filter != '.':
-        search_params.meta = {'HUC': args.huc_filter}
+        huc_filter = args.huc_filter
+        search_params.meta = {'HUC': huc_filter}
 
     with RiverscapesAPI(stage=args.stage) as api:
-        scrape_rme(api, args.spatialite_path, search_params, download_folder, args.s3_bucket, args.delete)
+        scrape_rme(api, args.spatialite_path, search_params, download_folder, args.s3_bucket, args.delete, huc_filter)
 
     log.info('Process complete')
 
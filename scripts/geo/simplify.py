@@ -28,22 +28,24 @@ print(f"Geopandas: {gpd.__version__}")
 # Read the GeoPackage
 in_file = r"C:\nardata\work\huc_wbd_nhd_align\final\lsg_processed_hu10.gpkg"
 in_layer = 'wbdhu10_conus_rs'
-gdf = gpd.read_file(in_file, layer=in_layer)
+# Only the columns we keep are read, in bulk through pyogrio's Arrow reader
+gdf = gpd.read_file(in_file, layer=in_layer, columns=["TNMID", "HUC10"], engine='pyogrio', use_arrow=True)
 print(f'Read {in_layer} from {in_file}.')
 
-# Reproject to EPSG:5070
-gdf = gdf.to_crs(epsg=5070)
-
-# Simplify all geometries using simplify_coverage on the GeoSeries
-gdf["geometry"] = gdf.geometry.simplify_coverage(tolerance=8000)
-
 # Select only the desired columns (geometry is always included if present)
 gdf_out = gdf[["TNMID", "HUC10", "geometry"]]
-# change (back?) to 4326 for Athena
-gdf_out.to_crs(epsg=4326)
+
+# Reproject to EPSG:5070, unless the layer is already in it
+geom = gdf_out.geometry
+if geom.crs is None or geom.crs.to_epsg() != 5070:
+    geom = geom.to_crs(epsg=5070)
+
+# Simplify all geometries using simplify_coverage on the GeoSeries,
+# then change (back?) to 4326 for Athena
+gdf_out = gdf_out.set_geometry(geom.simplify_coverage(tolerance=8000).to_crs(epsg=4326))
 
 # Save the result
 out_file = r"C:\nardata\work\huc_wbd_nhd_align\final\simplified_hu10.gpkg"
 out_layer = 'wbdhu10_conus_rs_simplified_8km'
-gdf_out.to_file(out_file, layer=out_layer, driver="GPKG")
+gdf_out.to_file(out_file, layer=out_layer, driver="GPKG", engine='pyogrio')
 print(f"wrote {out_layer} to {out_file}.")
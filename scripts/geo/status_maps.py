@@ -41,30 +41,35 @@ def generate_status_maps(gpkg_path: str, output_image_dir: str) -> list[str]:
         curs.execute('SELECT distinct project_Type_id FROM vw_projects')
         project_types = [row[0] for row in curs.fetchall()]
 
+        # Number of 2025 CONUS projects for every project type in one pass over the view
+        curs.execute("SELECT project_type_id, count(*) FROM vw_projects WHERE tags LIKE '%2025CONUS%' GROUP BY project_type_id")
+        project_counts = dict(curs.fetchall())
+
         gdf_outline = gpd.read_file(gpkg_path, layer="vw_conus_hucs")
 
         curs.execute('SELECT count(*) FROM vw_conus_hucs')
         outline_count = curs.fetchone()[0]
 
-        for project_type in project_types:
-            curs.execute("SELECT count(*) FROM vw_projects WHERE tags LIKE '%2025CONUS%' AND project_type_id = ?", (project_type,))
-            project_count = curs.fetchone()[0]
+        # --- Load layers ---
+        # Read the 2025 CONUS projects once and filter in memory for each project type below.
+        # The tag filter runs in OGR so the geometry of other projects is never parsed.
+        gdf_all = gpd.read_file(gpkg_path, layer="vw_projects", where="tags LIKE '%2025CONUS%'")
 
-            # --- Load layers ---
-            gdf_filled = gpd.read_file(gpkg_path, layer="vw_projects")
+        # --- Reproject outline if needed ---
+        if gdf_all.crs != gdf_outline.crs:
+            gdf_outline = gdf_outline.to_crs(gdf_all.crs)
+
+        for project_type in project_types:
+            project_count = project_counts.get(project_type, 0)
 
             # --- Optional filter (WHERE clause) ---
-            gdf_filled = gdf_filled[(gdf_filled["project_type_id"] == project_type) & (gdf_filled['tags'].str.contains('2025CONUS', na=False))]
+            gdf_filled = gdf_all[gdf_all["project_type_id"] == project_type]
 
             # Skip plotting if no data
             if gdf_filled.empty:
                 print(f"Skipping {project_type}: no matching features.")
                 continue
 
-            # --- Reproject outline if needed ---
-            if gdf_filled.crs != gdf_outline.crs:
-                gdf_outline = gdf_outline.to_crs(gdf_filled.crs)
-
             # --- Plot ---
             __fig, ax = plt.subplots(figsize=(10, 10))
 
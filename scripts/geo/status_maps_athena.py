@@ -62,22 +62,17 @@ def generate_status_maps(athena_output_dir: str, output_image_dir: str, output_g
 
     describe_gdf(gdf_outline, "gdf_outline")
 
+    # One query for the HUCs covered by every project type. The project polygons are the HUC10
+    # outlines already loaded above, so no geometry needs to be fetched or parsed again.
+    project_hucs = pd.read_sql('SELECT DISTINCT project_type_id, huc FROM conus_projects WHERE huc IS NOT NULL ORDER BY project_type_id', conn)
+
     # Loop over each 2025CONUS project type and generate a status map image for each
     image_paths = []
-    project_types = pd.read_sql('select distinct project_type_id from conus_projects', conn)
-    for project_type in project_types['project_type_id']:
-        project_count = pd.read_sql(f"SELECT count(distinct huc) FROM conus_projects WHERE project_type_id = '{project_type}'", con=conn)
-        project_count = project_count.iloc[0, 0]
-
-        # Read the project polygons for this type
-        projects_df = pd.read_sql(
-            f"""SELECT h.huc10, h.geometry
-                FROM conus_projects p INNER JOIN wbdhu10_conus_rs_simplified h ON p.huc = h.huc10
-                WHERE p.project_type_id = '{project_type}'""",
-            con=conn,
-        )
-        projects_df['geometry'] = projects_df['geometry'].apply(safe_load_geom)
-        projects_gdf = gpd.GeoDataFrame(projects_df, geometry='geometry', crs='EPSG:4326')
+    for project_type, type_hucs in project_hucs.groupby('project_type_id', sort=False):
+        project_count = len(type_hucs)
+
+        # Select the project polygons for this type
+        projects_gdf = gdf_outline[gdf_outline['huc10'].isin(type_hucs['huc'])]
         describe_gdf(projects_gdf, f"projects for {project_type}")
 
         # Skip plotting if no data